@@ -9,7 +9,10 @@
 import asyncio
 import re
 import struct
-from datetime import datetime
+import time
+from datetime import datetime, timedelta, timezone
+
+from typing import Optional
 
 from bleak import BleakScanner
 from bleak.backends.device import BLEDevice
@@ -19,18 +22,44 @@ from bleak.backends.scanner import AdvertisementData
 ADDRESSES = {"E0:13:D5:71:D0:66": "H5179", "A4:C1:38:82:A2:88": "H5072"}
 PORT = 1111
 
-
-def hex_string(data):
-    return "".join("{:02x} ".format(x) for x in data)
+# Temperature and humidity are signed int16 (two's complement), battery is a uint8.
+H5179_STRUCT = struct.Struct("<hhB")
+STATUS_RE = re.compile(rb"^status ((?:[0-9a-f]:?)+)$", re.IGNORECASE)
 
 
 def decode_temps_h5072(packet_value: int) -> float:
     """Decode potential negative temperatures."""
     # https://github.com/Thrilleratplay/GoveeWatcher/issues/2
 
-    if packet_value & 0x800000:
-        return float((packet_value ^ 0x800000) / -10000)
-    return float(packet_value / 10000)
+    # The top bit of the 24-bit value is the sign; the rest is the magnitude.
+    sign = 1 - ((packet_value >> 23) & 1) * 2
+    return (packet_value & 0x7FFFFF) / (sign * 10000)
+
+
+def parse_h5179(device_data: bytes) -> tuple[float, float, int]:
+    """Returns the temperature, humidity, and battery from H5179 manufacturer data."""
+
+    # The temperature, humidity, and batter are the last 5 bytes in the
+    # manufacturer data (not sure what the others are). Temperature and humidity
+    # are int16, while battery is a char (one byte). The data is little endian.
+    # Reference: https://bit.ly/2Pvssx9
+
+    offset = len(device_data) - H5179_STRUCT.size
+    temp, hum, bat = H5179_STRUCT.unpack_from(device_data, offset)
+
+    return temp / 100, hum / 100, bat
+
+
+def parse_h5072(device_data: bytes) -> tuple[float, float, int]:
+    """Returns the temperature, humidity, and battery from H5072 manufacturer data."""
+
+    packet = int.from_bytes(device_data[1:4], "big")
+
+    temp = decode_temps_h5072(packet)
+    hum = float((packet % 1000) / 10)
+    bat = device_data[4]
+
+    return temp, hum, bat
 
 
 class GoveeWatcher:
@@ -45,92 +74,176 @@ class GoveeWatcher:
         The port on localhost on which the TCP server will be started. The server
         accepts a single command, ``status``, and returns the address, temperature,
         humidity, battery, and the time of the last update in a single line.
+    idle_timeout
+        If set, client connections that do not send a command for this many seconds
+        are closed. By default connections are kept open indefinitely.
     """
 
-    def __init__(self, addresses: dict[str, str], port: int):
+    def __init__(
+        self,
+        addresses: dict[str, str],
+        port: int,
+        idle_timeout: Optional[float] = None,
+    ):
 
-        self.addresses = addresses
+        # Normalise the addresses once so that the callback needs a single lookup.
+        self.addresses = {addr.upper(): model for addr, model in addresses.items()}
         self.port = port
+        self.idle_timeout = idle_timeout
+
+        # Maps each address to [temperature, humidity, battery, last_update], where
+        # last_update is a monotonic timestamp in seconds.
+        self.state: dict[str, list] = {}
 
-        self.humidity = {}
-        self.temperature = {}
-        self.battery = {}
-        self.last_update = {}
+        # Encoded status line for each address, built from state when first requested
+        # after an update and dropped when a new reading arrives.
+        self._line_cache: dict[str, bytes] = {}
+
+        # All the status lines joined, returned by the plain status command. None if
+        # it needs to be rebuilt.
+        self._all_status_blob: Optional[bytes] = None
+
+        # Limits the number of clients served concurrently.
+        self._conn_sem = asyncio.Semaphore(64)
+
+        # Writers of the connected clients, closed when the watcher stops.
+        self._clients: set[asyncio.StreamWriter] = set()
+
+        self.server: Optional[asyncio.AbstractServer] = None
+        self._scanning = False
+        self._stop = asyncio.Event()
 
         self.scanner = BleakScanner()
         self.scanner.register_detection_callback(self.detection_callback)
 
     async def start(self):
-        """Starts the TCP server and the device discovery."""
+        """Starts the TCP server and the device discovery.
 
-        self.server = await asyncio.start_server(
-            self.handle_request,
-            "0.0.0.0",
-            self.port,
-        )
-        await self.server.start_serving()
+        Runs until `.stop` is called, after which the server and the scanner are shut
+        down. Does nothing if the watcher has already been stopped.
+        """
 
-        await self.scanner.start()
+        if self._stop.is_set():
+            return
 
-        while True:
-            await self.scanner.discover(5)
-            await asyncio.sleep(1)
+        try:
+            self.server = await asyncio.start_server(
+                self.handle_request,
+                "0.0.0.0",
+                self.port,
+                limit=4096,
+            )
+            await self.server.start_serving()
 
-    def detection_callback(self, device: BLEDevice, data: AdvertisementData):
-        """Called when an update is received from the bluetooth device."""
+            # The scanner keeps running and detection_callback is called for each
+            # advertisement, so there is no need to poll; just wait until stopped.
+            await self.scanner.start()
+            self._scanning = True
 
-        address = device.address.upper()
+            await self._stop.wait()
 
-        if address not in self.addresses:
+        finally:
+            # Also covers stop() being called while the scanner was still starting.
+            await self._shutdown()
+
+    async def stop(self):
+        """Stops the device discovery and the TCP server."""
+
+        self._stop.set()
+        await self._shutdown()
+
+    async def _shutdown(self):
+        """Stops the scanner and closes the server, if they are running."""
+
+        if self._scanning:
+            self._scanning = False
+            await self.scanner.stop()
+
+        if self.server is None:
             return
 
-        if self.addresses[address] == 'H5179':
+        server = self.server
+        self.server = None
+
+        # Since Python 3.12 wait_closed() also waits for the client connections, so
+        # those need to be closed too. Each handler returns once its reader hits EOF.
+        server.close()
+        for writer in list(self._clients):
+            writer.close()
+
+        await server.wait_closed()
 
-            # The temperature, humidity, and batter are the last 5 bytes in the
-            # manufacturer data (not sure what the others are). Temperature and humidity
-            # are uint8, while battery is a char (one byte). The data is little endian.
-            # Reference: https://bit.ly/2Pvssx9
+    def detection_callback(self, device: BLEDevice, data: AdvertisementData):
+        """Called when an update is received from the bluetooth device."""
+
+        address = device.address.upper()
+        model = self.addresses.get(address, None)
+
+        if model == "H5179":
 
             if 34817 not in data.manufacturer_data:
                 return
 
-            device_data: bytes = data.manufacturer_data[34817]
-
             try:
-                temp, hum, bat = struct.unpack_from("<HHB", device_data[-5:])
+                temp, hum, bat = parse_h5179(data.manufacturer_data[34817])
             except Exception:
                 return
 
-            # Negative values are encoded as two's complement of int16.
-            if temp & (1 << 15):
-                temp = temp - (1 << 16)
-            if hum & (1 << 15):
-                hum = hum - (1 << 16)
-
-            temp /= 100
-            hum /= 100
-
-        elif self.addresses[address] == 'H5072':
+        elif model == "H5072":
 
             if 60552 not in data.manufacturer_data:
                 return
 
-            device_data: bytes = data.manufacturer_data[60552]
+            temp, hum, bat = parse_h5072(data.manufacturer_data[60552])
 
-            mfg_data_5075 = hex_string(device_data[1:4]).replace(" ", "")
-            packet = int(mfg_data_5075, 16)
+        else:
+            return
 
-            temp = decode_temps_h5072(packet)
-            hum = float((packet % 1000) / 10)
-            bat = int(device_data[4])
+        now = time.monotonic()
 
+        state = self.state.get(address, None)
+        if state is None:
+            self.state[address] = [temp, hum, bat, now]
         else:
-            return
+            state[0] = temp
+            state[1] = hum
+            state[2] = bat
+            state[3] = now
+
+        # The status lines are rebuilt from the state the next time they are requested.
+        self._line_cache.pop(address, None)
+        self._all_status_blob = None
+
+    def get_status_line(self, address: str) -> Optional[bytes]:
+        """Returns the encoded status line for an address, or `None` if unknown."""
+
+        line = self._line_cache.get(address, None)
+        if line is not None:
+            return line
+
+        state = self.state.get(address, None)
+        if state is None:
+            return None
 
-        self.temperature[address] = temp
-        self.humidity[address] = hum
-        self.battery[address] = bat
-        self.last_update[address] = datetime.utcnow()
+        temp, hum, bat, last_update = state
+
+        # Reported as naive UTC to keep the format of the status line unchanged.
+        age = timedelta(seconds=time.monotonic() - last_update)
+        updated = (datetime.now(timezone.utc) - age).replace(tzinfo=None)
+
+        line = f"{address} {temp} {hum} {bat} {updated.isoformat()}\n".encode()
+        self._line_cache[address] = line
+
+        return line
+
+    def get_all_status(self) -> bytes:
+        """Returns the encoded status lines for all the devices seen."""
+
+        if self._all_status_blob is None:
+            lines = [self.get_status_line(address) for address in self.state]
+            self._all_status_blob = b"".join(lines)
+
+        return self._all_status_blob
 
     async def handle_request(
         self,
@@ -139,47 +252,67 @@ class GoveeWatcher:
     ):
         """Handle connections to the TCP server."""
 
-        while True:
-            try:
-                data = await reader.readline()
-
-                command = data.decode().strip().lower()
-                command_has_address = re.match('^status ((?:[0-9a-f]:?)+)', command)
-                
-                if command_has_address:
-                    command_address = command_has_address.groups()[0].upper()
-                    if command_address not in self.temperature:
-                        writer.write(b'?\n')
-                    else:
-                        writer.write(
-                            f"{command_address} {self.temperature[command_address]} "
-                            f"{self.humidity[command_address]} "
-                            f"{self.battery[command_address]} "
-                            f"{self.last_update[command_address].isoformat()}\n".encode()
-                        )
-                    await writer.drain()
-                    continue
-
-                if command.startswith("status"):
-                    for address in self.temperature:
-                        writer.write(
-                            f"{address} {self.temperature[address]} "
-                            f"{self.humidity[address]} "
-                            f"{self.battery[address]} "
-                            f"{self.last_update[address].isoformat()}\n".encode()
-                        )
-                        await writer.drain()
+        # Refuse new clients outright when all the slots are in use, rather than
+        # leaving them connected and waiting with no reply.
+        if self._conn_sem.locked():
+            writer.write(b"error: too many connections\n")
+            writer.close()
+            return
 
-                if reader.at_eof():
-                    return
-            except Exception:
-                continue
+        self._clients.add(writer)
+
+        try:
+            async with self._conn_sem:
+                while True:
+                    try:
+                        # Commands are matched as bytes to avoid decoding each request.
+                        line = await asyncio.wait_for(
+                            reader.readline(),
+                            self.idle_timeout,
+                        )
+                        command = line.strip().lower()
+
+                        if command == b"status":
+                            writer.write(self.get_all_status())
+                            await writer.drain()
+
+                        elif command.startswith(b"status"):
+                            match = STATUS_RE.match(command)
+                            if match:
+                                address = match.group(1).decode().upper()
+                                writer.write(self.get_status_line(address) or b'?\n')
+                            else:
+                                writer.write(self.get_all_status())
+                            await writer.drain()
+
+                        if reader.at_eof():
+                            return
+                    except (ConnectionError, asyncio.TimeoutError):
+                        return
+                    except Exception:
+                        # Do not keep spinning on a connection that has been closed.
+                        if reader.at_eof():
+                            return
+                        continue
+        finally:
+            self._clients.discard(writer)
+            writer.close()
 
 
 async def run():
     watcher = GoveeWatcher(ADDRESSES, PORT)
-    await watcher.start()
 
+    try:
+        await watcher.start()
+    finally:
+        await watcher.stop()
+
+
+if __name__ == "__main__":
 
-loop = asyncio.get_event_loop()
-loop.run_until_complete(run())
+    try:
+        import uvloop
+    except ImportError:
+        asyncio.run(run())
+    else:
+        uvloop.run(run())